@@ -1,8 +1,12 @@
 import os
 import re
+import hmac
 import logging
 import uuid
 import asyncio
+import random
+import inspect
+from collections import deque
 from urllib.parse import urlparse
 
 import aiohttp
@@ -12,6 +16,16 @@ import json
 from .chat import Chat, Sender
 from .reloader import run_with_reloader
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
 __author__ = "Stepan Zastupov"
 __copyright__ = "Copyright 2015-2017 Stepan Zastupov"
 __license__ = "MIT"
@@ -19,10 +33,21 @@ __license__ = "MIT"
 API_URL = "https://api.telegram.org"
 API_TIMEOUT = 60
 RETRY_TIMEOUT = 30
-RETRY_CODES = [429, 500, 502, 503, 504]
+RETRY_BACKOFF = 1
+RETRY_CODES = frozenset([429, 500, 502, 503, 504])
+
+# Coalesced messages sent within this window (in seconds) are merged
+COALESCE_WINDOW = 0.02
+MAX_MESSAGE_LENGTH = 4096
+
+# Connection pool settings for the default connectors
+CONNECTION_LIMIT = 32
+POLLING_CONNECTION_LIMIT = 2
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 75
 
 # Message types to be handled by bot.handle(...)
-MESSAGE_TYPES = [
+MESSAGE_TYPES = (
     "location",
     "photo",
     "document",
@@ -33,7 +58,6 @@ MESSAGE_TYPES = [
     "venue",
     "video",
     "game",
-    "delete_chat_photo",
     "new_chat_photo",
     "delete_chat_photo",
     "new_chat_member",
@@ -41,7 +65,8 @@ MESSAGE_TYPES = [
     "new_chat_title",
     "group_chat_created",
     "successful_payment",
-]
+)
+MESSAGE_TYPE_SET = frozenset(MESSAGE_TYPES)
 
 # Update types for
 MESSAGE_UPDATES = [
@@ -52,8 +77,27 @@ MESSAGE_UPDATES = [
     "successful_payment",
 ]
 
+# Syntax that hyperscan reads differently from re: "{,n}" is a literal,
+# "\s" leaves out \x1c-\x1f and "[:" starts a POSIX class. Prefiltering
+# such patterns could miss matches.
+_PREFILTER_UNSAFE_RE = re.compile(r"\{,|\\[sS]|\[:")
+
+# Patterns that can only match texts starting with a slash
+_SLASH_ANCHORED_RE = re.compile(r"(?:\^|\\A)/(?![?*{])")
+
 logger = logging.getLogger("aiotg")
 
+# Use orjson when available, it is several times faster than json
+if orjson:
+
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    json_loads = orjson.loads
+else:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
 
 class Bot:
     """Telegram bot framework designed for asyncio
@@ -61,11 +105,24 @@ class Bot:
     :param str api_token: Telegram bot token, ask @BotFather for this
     :param int api_timeout: Timeout for long polling
     :param str name: Bot name
-    :param callable json_serialize: JSON serializer function. (json.dumps by default)
-    :param callable json_deserialize: JSON deserializer function. (json.loads by default)
+    :param callable json_serialize: JSON serializer function.
+        (orjson if installed, json.dumps otherwise)
+    :param callable json_deserialize: JSON deserializer function.
+        (orjson if installed, json.loads otherwise)
     :param bool default_in_groups: Enables default callback in groups
     :param str proxy: Proxy URL to use for HTTP requests
     :param connector: Custom aiohttp connector
+    :param int connection_limit: Maximum number of simultaneous connections
+        to the API, ignored when a custom connector is given
+    :param int max_concurrency: Maximum number of handlers running at once,
+        unlimited by default
+    :param int max_retries: Maximum number of retries for throttled or
+        failed API calls, unlimited by default
+    :param bool sequential_chats: Run coroutine handlers for the updates
+        from the same chat one after another, in the order they arrived.
+        Different chats are still handled concurrently.
+    :param bool use_hyperscan: Prefilter handler patterns with hyperscan
+        (if installed) before matching them with :mod:`re`
     """
 
     _running = False
@@ -76,36 +133,68 @@ class Bot:
         api_token,
         api_timeout=API_TIMEOUT,
         name=None,
-        json_serialize=json.dumps,
-        json_deserialize=json.loads,
+        json_serialize=json_dumps,
+        json_deserialize=json_loads,
         default_in_groups=False,
         connector=None,
+        connection_limit=CONNECTION_LIMIT,
+        max_concurrency=None,
+        max_retries=None,
+        sequential_chats=False,
+        use_hyperscan=False,
     ):
         self.api_token = api_token
+        self._api_prefix = "{0}/bot{1}/".format(API_URL, api_token)
+        self._file_prefix = "{0}/file/bot{1}/".format(API_URL, api_token)
         self.api_timeout = api_timeout
         self.name = name
         self.json_serialize = json_serialize
         self.json_deserialize = json_deserialize
         self.default_in_groups = default_in_groups
         self._session = None
+        self._poll_session = None
         self._cleanups = []
         self._webhook_uuid = None
         self._connector = connector
-
-        def no_handle(mt):
-            return lambda chat, msg: logger.debug("no handle for %s", mt)
+        self.connection_limit = connection_limit
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self.max_retries = max_retries
+        self.sequential_chats = sequential_chats
+        self._chat_queues = {}
+        self._tasks = set()
+        self._outbox = {}
+        self._sending = {}
+        self._tracking = "track" in vars(self) or type(self).track is not Bot.track
 
         # Init default handlers and callbacks
-        self._handlers = {mt: no_handle(mt) for mt in MESSAGE_TYPES}
-        self._commands = []
-        self._callbacks = []
-        self._inlines = []
-        self._chosen_inline_result_callbacks = []
-        self._checkouts = []
+        self._handlers = dict.fromkeys(MESSAGE_TYPES, _ignore)
+        self._handler_keys = MESSAGE_TYPE_SET
+        self._commands = HandlerTable(use_hyperscan=use_hyperscan)
+        self._callbacks = HandlerTable(use_hyperscan=use_hyperscan)
+        self._inlines = HandlerTable(use_hyperscan=use_hyperscan)
+        self._chosen_inline_result_callbacks = HandlerTable(use_hyperscan=use_hyperscan)
+        self._checkouts = HandlerTable(use_hyperscan=use_hyperscan)
         self._default = lambda chat, message: None
-        self._default_callback = lambda chat, cq: None
-        self._default_inline = lambda iq: None
-        self._default_chosen_inline_result_callback = lambda res: None
+        self._default_callback = _ignore
+        self._default_inline = _ignore
+        self._default_chosen_inline_result_callback = _ignore
+        self._default_checkout = _ignore
+
+        self._update_handlers = {ut: self._process_message for ut in MESSAGE_UPDATES}
+        self._update_handlers.update(
+            inline_query=self._process_inline_query,
+            callback_query=self._process_callback_query,
+            pre_checkout_query=self._process_pre_checkout_query,
+            chosen_inline_result=self._process_chosen_inline_result,
+        )
+        self._update_types = frozenset(self._update_handlers)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        # A track hook assigned on the instance has to be called too
+        if name == "track":
+            super().__setattr__("_tracking", True)
 
     async def loop(self):
         """
@@ -122,18 +211,93 @@ class Bot:
         >>> loop.create_task(bot.loop())
         """
         self._running = True
-        while self._running:
-            updates = await self.api_call(
-                "getUpdates", offset=self._offset + 1, timeout=self.api_timeout
+        confirmed = self._offset
+        errors = 0
+        poll = self._get_updates()
+        try:
+            while self._running:
+                # Offset of the pending poll, it confirms everything before it
+                polled = self._offset
+                try:
+                    updates = await poll
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # Network failures are usually transient, back off and
+                    # poll again instead of stopping the bot
+                    timeout = min(RETRY_TIMEOUT, RETRY_BACKOFF * 2**errors)
+                    logger.warning(
+                        "getUpdates failed (%r), retrying in %d sec.", e, timeout
+                    )
+                    await asyncio.sleep(timeout + random.random())
+                    errors += 1
+                    poll = self._get_updates()
+                    continue
+                errors = 0
+                confirmed = polled
+                if updates.get("ok") and updates["result"]:
+                    last_id = updates["result"][-1]["update_id"]
+                    self._offset = max(self._offset, last_id)
+
+                # Don't fetch more updates while too many handlers are running
+                if self.max_concurrency:
+                    await self._wait_for_handlers(self.max_concurrency)
+
+                # Issue the next long poll before dispatching the batch,
+                # so the round trip overlaps with handlers scheduling
+                if self._running:
+                    poll = self._get_updates()
+                self._process_updates(updates)
+        finally:
+            poll.cancel()
+
+        # Telegram confirms updates once getUpdates is called with a greater
+        # offset. The poll doing it for the last batch might have been
+        # cancelled above, confirm explicitly so the batch is not delivered
+        # again on the next start.
+        if self._offset > confirmed:
+            await self._api_call(
+                "getUpdates", offset=self._offset + 1, timeout=0, limit=1
             )
-            self._process_updates(updates)
 
-    def run(self, debug=False, reload=None):
+    def _get_updates(self):
+        return self.api_call(
+            "getUpdates",
+            offset=self._offset + 1,
+            timeout=self.api_timeout,
+            allowed_updates=self._allowed_updates(),
+        )
+
+    def _allowed_updates(self):
+        # Don't make Telegram send updates nobody is going to handle.
+        # Computed for every poll, so handlers added later are picked up.
+        optional = {
+            "inline_query": (self._inlines, self._default_inline),
+            "chosen_inline_result": (
+                self._chosen_inline_result_callbacks,
+                self._default_chosen_inline_result_callback,
+            ),
+            "callback_query": (self._callbacks, self._default_callback),
+            "pre_checkout_query": (self._checkouts, self._default_checkout),
+        }
+        allowed = []
+        for ut in self._update_handlers:
+            # Not an update type on its own, it comes within messages
+            if ut == "successful_payment":
+                continue
+            if ut in optional:
+                table, default = optional[ut]
+                if not table and default is _ignore:
+                    continue
+            allowed.append(ut)
+        return allowed
+
+    def run(self, debug=False, reload=None, eager=False):
         """
         Convenience method for running bots in getUpdates mode
 
         :param bool debug: Enable debug logging and automatic reloading
         :param bool reload: Automatically reload bot on code change
+        :param bool eager: Run handlers and API calls eagerly with
+            :func:`asyncio.eager_task_factory` (Python 3.12+)
         :Example:
 
         >>> if __name__ == '__main__':
@@ -147,6 +311,16 @@ class Bot:
         if reload is None:
             reload = debug
 
+        # Handlers and API calls start right away instead of waiting for
+        # the next loop iteration, the ones that never suspend are never
+        # scheduled at all
+        task_factory = loop.get_task_factory()
+        if eager:
+            if hasattr(asyncio, "eager_task_factory"):
+                loop.set_task_factory(asyncio.eager_task_factory)
+            else:
+                logger.warning("Eager tasks require Python 3.12 or newer")
+
         bot_loop = asyncio.ensure_future(self.loop())
 
         try:
@@ -166,7 +340,8 @@ class Bot:
         finally:
             for cleanup_action in self._cleanups:
                 cleanup_action()
-            loop.run_until_complete(self.session.close())
+            loop.run_until_complete(self.close())
+            loop.set_task_factory(task_factory)
 
             logger.debug("Closing loop")
             loop.stop()
@@ -191,13 +366,13 @@ class Bot:
             host = os.environ.get("HOST", "0.0.0.0")
             port = int(os.environ.get("PORT", 0)) or url.port
 
-            app.on_cleanup.append(lambda _: self.session.close())
+            app.on_cleanup.append(lambda _: self.close())
             for cleanup_action in self._cleanups:
                 app.on_cleanup.append(cleanup_action)
 
             web.run_app(app, host=host, port=port, loop=loop)
         else:
-            loop.run_until_complete(self.session.close())
+            loop.run_until_complete(self.close())
 
     def stop_webhook(self):
         """
@@ -209,13 +384,14 @@ class Bot:
         """
         Manually register regexp based command
         """
-        self._commands.append((regexp, fn))
+        self._commands.add(regexp, fn)
 
     def command(self, regexp):
         """
         Register a new command
 
-        :param str regexp: Regular expression matching the command to register
+        :param regexp: Regular expression (``str`` or compiled pattern)
+            matching the command to register
 
         :Example:
 
@@ -249,7 +425,7 @@ class Bot:
         """
         Manually register regexp based callback
         """
-        self._inlines.append((regexp, fn))
+        self._inlines.add(regexp, fn)
 
     def inline(self, callback):
         """
@@ -272,7 +448,7 @@ class Bot:
         if callable(callback):
             self._default_inline = callback
             return callback
-        elif isinstance(callback, str):
+        elif isinstance(callback, (str, re.Pattern)):
 
             def decorator(fn):
                 self.add_inline(callback, fn)
@@ -286,7 +462,7 @@ class Bot:
         """
         Manually register regexp based callback for the ``chosen_inline_result`` updates
         """
-        self._chosen_inline_result_callbacks.append((regexp, fn))
+        self._chosen_inline_result_callbacks.add(regexp, fn)
 
     def chosen_inline_result_callback(self, callback):
         """
@@ -305,7 +481,7 @@ class Bot:
         if callable(callback):
             self._default_chosen_inline_result_callback = callback
             return callback
-        elif isinstance(callback, str):
+        elif isinstance(callback, (str, re.Pattern)):
 
             def decorator(fn):
                 self.add_chosen_inline_result_callback(callback, fn)
@@ -319,7 +495,7 @@ class Bot:
         """
         Manually register regexp based callback
         """
-        self._callbacks.append((regexp, fn))
+        self._callbacks.add(regexp, fn)
 
     def callback(self, callback):
         """
@@ -338,7 +514,7 @@ class Bot:
         if callable(callback):
             self._default_callback = callback
             return callback
-        elif isinstance(callback, str):
+        elif isinstance(callback, (str, re.Pattern)):
 
             def decorator(fn):
                 self.add_callback(callback, fn)
@@ -352,12 +528,12 @@ class Bot:
         """
         Manually register regexp based checkout handler
         """
-        self._checkouts.append((regexp, fn))
+        self._checkouts.add(regexp, fn)
 
     def checkout(self, callback):
         if callable(callback):
             self._default_checkout = callback
-        elif isinstance(callback, str):
+        elif isinstance(callback, (str, re.Pattern)):
 
             def decorator(fn):
                 self.add_checkout(callback, fn)
@@ -380,6 +556,8 @@ class Bot:
 
         def wrap(callback):
             self._handlers[msg_type] = callback
+            if msg_type not in self._handler_keys:
+                self._handler_keys = frozenset(self._handlers)
             return callback
 
         return wrap
@@ -414,6 +592,9 @@ class Bot:
 
         See https://core.telegram.org/bots/api for reference.
 
+        The call is scheduled as a task right away, so it is executed even
+        if the result is never awaited.
+
         :param str method: Telegram API method
         :param params: Arguments for the method call
         """
@@ -422,37 +603,88 @@ class Bot:
         return asyncio.ensure_future(coro)
 
     async def _api_call(self, method, **params):
-        url = "{0}/bot{1}/{2}".format(API_URL, self.api_token, method)
-        logger.debug("api_call %s, %s", method, params)
+        url = self._api_prefix + method
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("api_call %s, %s", method, params)
 
-        response = await self.session.post(url, data=params)
+        if method == "getUpdates":
+            session = self._polling_session
+        else:
+            session = self.session
+
+        # Files have to be uploaded as a multipart form, everything else
+        # is sent as a single JSON document
+        if any(_is_file(value) for value in params.values()):
+            body = {"data": self._form_params(params)}
+        elif None in params.values():
+            body = {"json": {k: v for k, v in params.items() if v is not None}}
+        else:
+            # Keyword arguments are a fresh dict already, send it as is
+            body = {"json": params}
+
+        attempt = 0
+        while True:
+            # The connection goes back to the pool as soon as the block is
+            # left, before sleeping on retries
+            async with session.post(url, **body) as response:
+                if response.status == 200:
+                    if self.json_deserialize is json_loads:
+                        # Both orjson and json parse bytes, skip decoding
+                        # the whole body into a str first
+                        return json_loads(await response.read())
+                    return await response.json(loads=self.json_deserialize)
+
+                retry = response.status in RETRY_CODES
+                if retry and (self.max_retries is None or attempt < self.max_retries):
+                    # Telegram tells how long to wait on 429, otherwise back
+                    # off exponentially up to RETRY_TIMEOUT
+                    timeout = await self._retry_after(response)
+                    if timeout is None:
+                        timeout = min(RETRY_TIMEOUT, RETRY_BACKOFF * 2**attempt)
+                else:
+                    if response.content_type == "application/json":
+                        json_resp = await response.json(loads=self.json_deserialize)
+                        err_msg = json_resp["description"]
+                    else:
+                        err_msg = await response.read()
+                    logger.error(err_msg)
+                    raise BotApiError(err_msg, response=response)
 
-        if response.status == 200:
-            return await response.json(loads=self.json_deserialize)
-        elif response.status in RETRY_CODES:
             logger.info(
-                "Server returned %d, retrying in %d sec.",
-                response.status,
-                RETRY_TIMEOUT,
+                "Server returned %d, retrying in %d sec.", response.status, timeout
             )
-            await response.release()
-            await asyncio.sleep(RETRY_TIMEOUT)
-            return await self.api_call(method, **params)
-        else:
-            if response.headers["content-type"] == "application/json":
-                json_resp = await response.json(loads=self.json_deserialize)
-                err_msg = json_resp["description"]
-            else:
-                err_msg = await response.read()
-            logger.error(err_msg)
-            raise BotApiError(err_msg, response=response)
+            # Jitter keeps concurrent calls from retrying all at once
+            await asyncio.sleep(timeout + random.random())
+            attempt += 1
+
+    def _form_params(self, params):
+        form = {}
+        for key, value in params.items():
+            if value is None:
+                continue
+            if isinstance(value, (dict, list, tuple, bool)):
+                value = self.json_serialize(value)
+            elif not isinstance(value, str) and not _is_file(value):
+                value = str(value)
+            form[key] = value
+        return form
+
+    async def _retry_after(self, response):
+        if "Retry-After" in response.headers:
+            try:
+                return int(response.headers["Retry-After"])
+            except ValueError:
+                return None
+        if response.content_type == "application/json":
+            json_resp = await response.json(loads=self.json_deserialize)
+            return json_resp.get("parameters", {}).get("retry_after")
 
     async def get_me(self):
         """
         Returns basic information about the bot
         (see https://core.telegram.org/bots/api#getme)
         """
-        json_result = await self.api_call("getMe")
+        json_result = await self._api_call("getMe")
         return json_result["result"]
 
     async def leave_chat(self, chat_id):
@@ -464,20 +696,96 @@ class Bot:
             or username of the target supergroup or channel \
             (in the format @channelusername)
         """
-        json_result = await self.api_call("leaveChat", chat_id=chat_id)
+        json_result = await self._api_call("leaveChat", chat_id=chat_id)
         return json_result["result"]
 
-    def send_message(self, chat_id, text, **options):
+    def send_message(self, chat_id, text, coalesce=False, **options):
         """
         Send a text message to chat
 
         :param int chat_id: ID of the chat to send the message to
         :param str text: Text to send
+        :param bool coalesce: Merge the text with the coalesced messages
+            sent to the same chat right before it with the same options,
+            all of them resolve to the single resulting message. Messages
+            to a chat are delivered in the order they were sent.
         :param options: Additional sendMessage options
             (see https://core.telegram.org/bots/api#sendmessage)
         """
+        if coalesce:
+            return self._coalesce(chat_id, text, options)
+        # Coalesced messages queued for the chat go out first
+        self._flush_outbox(chat_id)
+        if chat_id in self._sending:
+            params = dict(options, chat_id=chat_id, text=text)
+            return self._send_in_order(chat_id, params)
         return self.api_call("sendMessage", chat_id=chat_id, text=text, **options)
 
+    def _coalesce(self, chat_id, text, options):
+        try:
+            key = frozenset(options.items())
+        except TypeError:
+            # Messages with markup are never merged
+            return self.send_message(chat_id, text, **options)
+
+        # One open batch per chat, a message that can't join it closes it
+        pending = self._outbox.get(chat_id)
+        if pending is not None:
+            pending_key, batch, _ = pending
+            length = sum(len(t) + 1 for t, _ in batch) + len(text)
+            if pending_key != key or length > MAX_MESSAGE_LENGTH:
+                self._flush_outbox(chat_id)
+                pending = None
+        if pending is None:
+            timer = asyncio.get_running_loop().call_later(
+                COALESCE_WINDOW, self._flush_outbox, chat_id
+            )
+            pending = self._outbox[chat_id] = (key, [], timer)
+
+        future = asyncio.get_running_loop().create_future()
+        pending[1].append((text, future))
+        return future
+
+    def _flush_outbox(self, chat_id):
+        pending = self._outbox.pop(chat_id, None)
+        if pending is None:
+            return
+        key, batch, timer = pending
+        timer.cancel()
+        text = "\n".join(t for t, _ in batch)
+        self._send_in_order(chat_id, dict(key, chat_id=chat_id, text=text), batch)
+
+    def _send_in_order(self, chat_id, params, batch=None):
+        # While something is being sent to the chat, the next message waits
+        # for it to keep the order
+        previous = self._sending.get(chat_id)
+        task = asyncio.ensure_future(self._send_after(previous, params, batch))
+        self._sending[chat_id] = task
+
+        def done(task):
+            if self._sending.get(chat_id) is task:
+                del self._sending[chat_id]
+
+        task.add_done_callback(done)
+        return task
+
+    async def _send_after(self, previous, params, batch):
+        if previous is not None:
+            await asyncio.wait([previous])
+        if batch is None:
+            return await self._api_call("sendMessage", **params)
+
+        try:
+            result = await self._api_call("sendMessage", **params)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(result)
+
     def edit_message_text(self, chat_id, message_id, text, **options):
         """
         Edit a text message in a chat
@@ -501,7 +809,7 @@ class Bot:
 
         :param int chat_id: ID of the chat the message to edit is in
         :param int message_id: ID of the message to edit
-        :param str reply_markup: New inline keyboard markup for the message
+        :param dict reply_markup: New inline keyboard markup for the message
         :param options: Additional API options
         """
         return self.api_call(
@@ -519,7 +827,7 @@ class Bot:
         :param int file_id: File identifier to get information about
         :return: File object (see https://core.telegram.org/bots/api#file)
         """
-        json = await self.api_call("getFile", file_id=file_id)
+        json = await self._api_call("getFile", file_id=file_id)
         return json["result"]
 
     def download_file(self, file_path, range=None):
@@ -527,7 +835,7 @@ class Bot:
         Download a file from Telegram servers
         """
         headers = {"range": range} if range else None
-        url = "{0}/file/bot{1}/{2}".format(API_URL, self.api_token, file_path)
+        url = self._file_prefix + file_path
         return self.session.get(url, headers=headers)
 
     def get_user_profile_photos(self, user_id, **options):
@@ -538,13 +846,27 @@ class Bot:
         :param options: Additional getUserProfilePhotos options (see
             https://core.telegram.org/bots/api#getuserprofilephotos)
         """
-        return self.api_call("getUserProfilePhotos", user_id=str(user_id), **options)
+        return self.api_call("getUserProfilePhotos", user_id=user_id, **options)
 
     def track(self, message, name="Message"):
-        # TODO allow configuring custom tracking
+        """
+        Hook called for every handled message, override it in a subclass
+        or assign it on the instance to collect analytics. It is skipped
+        entirely when not overridden.
+
+        :param dict message: Incoming message
+        :param str name: Message type or name of the handler
+        """
         pass
 
     def stop(self):
+        """
+        Stop the getUpdates loop.
+
+        The HTTP session is left open since handlers may still be sending
+        replies, ``run()`` closes it on exit. If you run ``loop()`` yourself,
+        await ``close()`` once you are done.
+        """
         self._running = False
 
     async def webhook_handle(self, request):
@@ -558,11 +880,26 @@ class Bot:
         >>> app.router.add_route('/webhook')
         """
 
-        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self._webhook_uuid:
-            logger.warning("Probably, a malicious request! " + request)
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
+        if self._webhook_uuid is None:
+            authorized = token is None
+        elif token is None:
+            authorized = False
+        else:
+            try:
+                # Undecodable header bytes are passed as lone surrogates
+                token = token.encode("utf-8", "surrogateescape")
+            except UnicodeEncodeError:
+                authorized = False
+            else:
+                authorized = hmac.compare_digest(token, self._webhook_uuid)
+        if not authorized:
+            logger.warning("Probably, a malicious request! %s", request)
             return web.Response(status=403)
 
         update = await request.json(loads=self.json_deserialize)
+        # Webhook deliveries can come out of order
+        self._offset = max(self._offset, update["update_id"])
         self._process_update(update)
         return web.Response()
 
@@ -579,11 +916,14 @@ class Bot:
         Register you webhook url for Telegram service.
 
         A newly generated UUID will be used as a secret_token parameter
-        if it's not specified explicitly
+        if it's not specified explicitly. Unless allowed_updates is given,
+        only the update types with registered handlers are requested, so
+        register the handlers first.
         """
         if "secret_token" not in options:
             options["secret_token"] = str(uuid.uuid4())
-        self._webhook_uuid = options["secret_token"]
+        options.setdefault("allowed_updates", self._allowed_updates())
+        self._webhook_uuid = options["secret_token"].encode()
         return self.api_call("setWebhook", url=webhook_url, **options)
 
     def delete_webhook(self):
@@ -604,111 +944,399 @@ class Bot:
         """
         self._cleanups.append(action)
 
+    async def close(self):
+        """
+        Close the HTTP session, use it if you run bot.loop() yourself
+
+        :Example:
+
+        >>> try:
+        >>>     await bot.loop()
+        >>> finally:
+        >>>     await bot.close()
+        """
+        # Deliver the messages still being coalesced while the session is open
+        for chat_id in list(self._outbox):
+            self._flush_outbox(chat_id)
+        if self._sending:
+            await asyncio.wait(list(self._sending.values()))
+
+        for session in (self._session, self._poll_session):
+            if session and not session.closed:
+                await session.close()
+        self._session = None
+        self._poll_session = None
+
     @property
     def session(self):
+        """
+        aiohttp.ClientSession shared by all requests of the bot.
+
+        It is created on first use and lives until ``close()`` is called,
+        so the connection pool (and keep-alive connections to Telegram)
+        are reused between API calls.
+        """
         if not self._session or self._session.closed:
-            self._session = aiohttp.ClientSession(
-                json_serialize=self.json_serialize, connector=self._connector
-            )
+            self._session = self._create_session(self._connector, self.connection_limit)
         return self._session
 
-    def _process_message(self, message):
-        chat = Chat.from_message(self, message)
+    @property
+    def _polling_session(self):
+        # getUpdates long polls get a small pool of their own, so they
+        # neither wait for nor hold connections used for sending replies.
+        # A custom connector (e.g. a proxy) can't be duplicated though.
+        if self._connector is not None:
+            return self.session
+        if not self._poll_session or self._poll_session.closed:
+            self._poll_session = self._create_session(None, POLLING_CONNECTION_LIMIT)
+        return self._poll_session
+
+    def _create_session(self, connector, limit):
+        if connector is None:
+            # All requests go to a single host, keep connections to it
+            # alive and don't resolve it over and over again
+            connector = aiohttp.TCPConnector(
+                limit=limit,
+                limit_per_host=limit,
+                ttl_dns_cache=DNS_CACHE_TTL,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+            )
+        # getUpdates may legitimately wait for api_timeout seconds
+        timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=15, sock_read=self.api_timeout + 5
+        )
+        return aiohttp.ClientSession(
+            json_serialize=self.json_serialize,
+            connector=connector,
+            timeout=timeout,
+        )
 
-        for mt, func in self._handlers.items():
-            if mt in message:
+    def _process_message(self, message):
+        text = message.get("text")
+        # None of the standard message types comes with text, look for them
+        # only if the bot handles custom ones (e.g. "reply_to_message")
+        if text is not None and self._handler_keys is MESSAGE_TYPE_SET:
+            return self._process_text(message, text)
+
+        # Chat is only built once there's something to dispatch the message to
+        hit = self._handler_keys.intersection(message)
+        if hit:
+            if len(hit) == 1:
+                (mt,) = hit
+            else:
+                # Some messages carry several types (venue comes with location),
+                # keep the priority of MESSAGE_TYPES for them
+                mt = next(mt for mt in self._handlers if mt in hit)
+            if self._tracking:
                 self.track(message, mt)
-                return func(chat, message[mt])
-
-        if "text" not in message:
-            return
-
-        for patterns, handler in self._commands:
-            m = re.search(patterns, message["text"], re.I)
-            if m:
+            handler = self._handlers[mt]
+            if handler is _ignore:
+                logger.debug("no handle for %s", mt)
+                return
+            return handler(Chat.from_message(self, message), message[mt])
+
+        if text is not None:
+            return self._process_text(message, text)
+
+    def _process_text(self, message, text):
+        handler, m = self._commands.search(text)
+        if handler:
+            if self._tracking:
                 self.track(message, handler.__name__)
-                return handler(chat, m)
+            return handler(Chat.from_message(self, message), m)
 
         # No match, run default if it's a 1to1 chat
         # However, if default_in_groups option is active, run default in any chat (not only 1to1)
-        if not chat.is_group() or self.default_in_groups:
-            self.track(message, "default")
+        chat = Chat.from_message(self, message)
+        if self.default_in_groups or not chat.is_group():
+            if self._tracking:
+                self.track(message, "default")
             return self._default(chat, message)
 
     def _process_inline_query(self, query):
         iq = InlineQuery(self, query)
 
-        for patterns, handler in self._inlines:
-            match = re.search(patterns, query["query"], re.I)
-            if match:
-                return handler(iq, match)
+        handler, match = self._inlines.search(query["query"])
+        if handler:
+            return handler(iq, match)
         return self._default_inline(iq)
 
     def _process_chosen_inline_result(self, result):
         cir = ChosenInlineResult(self, result)
-        for patterns, handler in self._chosen_inline_result_callbacks:
-            match = re.search(patterns, result["query"], re.I)
-            if match:
-                return handler(cir, match)
+        handler, match = self._chosen_inline_result_callbacks.search(result["query"])
+        if handler:
+            return handler(cir, match)
         return self._default_chosen_inline_result_callback(cir)
 
     def _process_callback_query(self, query):
-        chat = Chat.from_message(self, query["message"]) if "message" in query else None
         cq = CallbackQuery(self, query)
-        for patterns, handler in self._callbacks:
-            match = re.search(patterns, cq.data, re.I)
-            if match:
-                return handler(chat, cq, match)
+        handler, match = self._callbacks.search(cq.data)
+        if handler is None and self._default_callback is _ignore:
+            return
+
+        # Chat is only built once there's something to dispatch the query to
+        chat = Chat.from_message(self, query["message"]) if "message" in query else None
+        if handler:
+            return handler(chat, cq, match)
 
-        if chat and not chat.is_group() or self.default_in_groups:
+        if self.default_in_groups or chat and not chat.is_group():
             return self._default_callback(chat, cq)
 
     def _process_pre_checkout_query(self, query):
         pcq = PreCheckoutQuery(self, query)
 
-        for patterns, handler in self._checkouts:
-            match = re.search(patterns, pcq.invoice_payload, re.I)
-            if match:
-                return handler(pcq, match)
+        handler, match = self._checkouts.search(pcq.invoice_payload)
+        if handler:
+            return handler(pcq, match)
         return self._default_checkout(pcq)
 
     def _process_updates(self, updates):
-        if not updates["ok"]:
+        if not updates.get("ok"):
             logger.error("getUpdates error: %s", updates.get("description"))
             return
 
+        process_update = self._process_update
         for update in updates["result"]:
-            self._process_update(update)
+            process_update(update)
 
     def _process_update(self, update):
-        logger.debug("update %s", update)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("update %s", update)
 
-        # Update offset
-        self._offset = max(self._offset, update["update_id"])
+        # Determine update type, message updates take precedence
+        hit = self._update_types.intersection(update)
+        if not hit:
+            logger.error("don't know how to handle update: %s", update)
+            return
+        if len(hit) == 1:
+            (ut,) = hit
+        else:
+            ut = next(ut for ut in self._update_handlers if ut in hit)
+
+        coro = self._update_handlers[ut](update[ut])
+        if self.sequential_chats and asyncio.iscoroutine(coro):
+            chat_id = _chat_id(update[ut])
+            if chat_id is not None:
+                return self._schedule_in_chat(chat_id, coro)
+        self._schedule(coro)
+
+    def _schedule_in_chat(self, chat_id, coro):
+        queue = self._chat_queues.get(chat_id)
+        if queue is not None:
+            queue.append(coro)
+        else:
+            # Queue first, an eagerly started worker would exit right away
+            queue = self._chat_queues[chat_id] = deque([coro])
+            self._schedule(self._chat_worker(chat_id, queue))
+
+    async def _chat_worker(self, chat_id, queue):
+        # The worker exits as soon as the chat has nothing queued, the next
+        # update from the chat starts a new one
+        try:
+            while queue:
+                coro = queue.popleft()
+                try:
+                    await coro
+                except Exception:
+                    logger.exception("Handler failed")
+        finally:
+            if self._chat_queues.get(chat_id) is queue:
+                del self._chat_queues[chat_id]
+            # Don't leave never awaited coroutines behind on cancellation
+            while queue:
+                queue.popleft().close()
+
+    def _schedule(self, coro):
+        # Handlers return coroutines, API call futures (already running)
+        # or anything else, which is ignored
+        if asyncio.iscoroutine(coro):
+            if self.max_concurrency:
+                coro = self._bounded(coro)
+            task = asyncio.get_running_loop().create_task(coro)
+        elif inspect.isawaitable(coro) and not asyncio.isfuture(coro):
+            task = asyncio.ensure_future(coro)
+        else:
+            return
+        self._tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+
+    def _on_task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Handler failed", exc_info=task.exception())
+
+    async def _bounded(self, coro):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await coro
+
+    async def _wait_for_handlers(self, limit):
+        while len(self._tasks) >= limit:
+            await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+
+
+def _is_file(value):
+    return isinstance(value, (bytes, bytearray)) or hasattr(value, "read")
+
+
+def _ignore(*args):
+    pass
+
+
+def _chat_id(payload):
+    # Messages carry their chat, callback queries carry the message they
+    # were sent from (if any), other queries only know the user
+    chat = payload.get("chat") or payload.get("message", {}).get("chat")
+    if chat is not None:
+        return chat["id"]
+    sender = payload.get("from")
+    return sender["id"] if sender is not None else None
 
-        coro = None
 
-        # Determine update type starting with message updates
-        for ut in MESSAGE_UPDATES:
-            if ut in update:
-                coro = self._process_message(update[ut])
-                break
+def _is_slash_anchored(pattern):
+    # Any alternation could make the anchor apply to a single branch only,
+    # with re.M "^" matches after every newline and with re.X whitespace
+    # may separate the slash from a quantifier
+    return (
+        _SLASH_ANCHORED_RE.match(pattern.pattern) is not None
+        and "|" not in pattern.pattern
+        and not pattern.flags & (re.M | re.X)
+    )
+
+
+class HandlerTable:
+    """
+    Ordered collection of regexp based handlers.
+
+    Patterns are compiled once at registration and tried one by one, the
+    first registered pattern found in the text wins.
+
+    Patterns anchored to a leading slash are not tried at all for the texts
+    that don't start with one.
+
+    With ``use_hyperscan`` and `hyperscan
+    <https://github.com/darvid/python-hyperscan>`__ installed, all patterns
+    are scanned in a single pass first and only the candidates it reports
+    are confirmed with :mod:`re`. Tables using syntax that hyperscan reads
+    differently from :mod:`re` are always scanned with :mod:`re` alone.
+    """
+
+    def __init__(self, flags=re.I, use_hyperscan=False):
+        self.flags = flags
+        self.use_hyperscan = use_hyperscan
+        # Handlers are registered once and read on every update, the tuple
+        # is rebuilt by add() along with the derived matchers
+        self._handlers = ()
+        self._database = None
+        self._slash_anchored = 0
+        self._unslashed = None
+
+    def add(self, regexp, fn):
+        if isinstance(regexp, re.Pattern):
+            pattern = regexp
         else:
-            if "inline_query" in update:
-                coro = self._process_inline_query(update["inline_query"])
-            elif "callback_query" in update:
-                coro = self._process_callback_query(update["callback_query"])
-            elif "pre_checkout_query" in update:
-                coro = self._process_pre_checkout_query(update["pre_checkout_query"])
-            elif "chosen_inline_result" in update:
-                coro = self._process_chosen_inline_result(
-                    update["chosen_inline_result"]
+            pattern = re.compile(regexp, self.flags)
+
+        if _is_slash_anchored(pattern):
+            self._slash_anchored += 1
+        self._handlers += ((pattern, fn),)
+        self._database = None
+        self._unslashed = None
+
+    def __iter__(self):
+        return iter(self._handlers)
+
+    def __len__(self):
+        return len(self._handlers)
+
+    def search(self, text):
+        """
+        Find the handler for the text
+
+        :param str text: Text to match against registered patterns
+        :return: ``(handler, match)`` tuple or ``(None, None)`` if nothing matched
+        """
+        if self._slash_anchored and text[:1] != "/":
+            # Leave out the patterns that can't match, the order of the
+            # others stays the same
+            if self._unslashed is None:
+                self._unslashed = HandlerTable(self.flags, self.use_hyperscan)
+                self._unslashed._handlers = tuple(
+                    h for h in self._handlers if not _is_slash_anchored(h[0])
                 )
-            else:
-                logger.error("don't know how to handle update: %s", update)
+            return self._unslashed.search(text)
+
+        if self._database is None:
+            self._database = self._compile_database()
 
-        if coro:
-            asyncio.ensure_future(coro)
+        if self._database:
+            try:
+                return self._search_database(text)
+            except UnicodeEncodeError:
+                # Lone surrogates can't be passed to hyperscan
+                pass
+
+        for pattern, handler in self._handlers:
+            m = pattern.search(text)
+            if m:
+                return handler, m
+        return None, None
+
+    def _search_database(self, text):
+        found = set()
+        self._database.scan(
+            text.encode(), match_event_handler=lambda i, *args: found.add(i)
+        )
+        # Prefilter mode may report false positives but never misses a
+        # match, so the candidates are confirmed in registration order
+        for i in sorted(found):
+            pattern, handler = self._handlers[i]
+            m = pattern.search(text)
+            if m:
+                return handler, m
+        return None, None
+
+    def _compile_database(self):
+        if not self.use_hyperscan or hyperscan is None or len(self._handlers) < 2:
+            return False
+        if any(_PREFILTER_UNSAFE_RE.search(p.pattern) for p, _ in self._handlers):
+            return False
+        if not self._uniform_flags():
+            return False
+        if self.flags & ~(re.I | re.M | re.S | re.U):
+            return False
+
+        flags = (
+            hyperscan.HS_FLAG_PREFILTER
+            | hyperscan.HS_FLAG_SINGLEMATCH
+            | hyperscan.HS_FLAG_UTF8
+            | hyperscan.HS_FLAG_UCP
+        )
+        if self.flags & re.I:
+            flags |= hyperscan.HS_FLAG_CASELESS
+        if self.flags & re.M:
+            flags |= hyperscan.HS_FLAG_MULTILINE
+        if self.flags & re.S:
+            flags |= hyperscan.HS_FLAG_DOTALL
+
+        database = hyperscan.Database()
+        try:
+            database.compile(
+                expressions=[p.pattern.encode() for p, _ in self._handlers],
+                ids=list(range(len(self._handlers))),
+                elements=len(self._handlers),
+                flags=[flags] * len(self._handlers),
+            )
+        except hyperscan.error:
+            return False
+        return database
+
+    def _uniform_flags(self):
+        # Pre-compiled patterns may come with flags of their own, merging
+        # them would apply the table flags instead
+        flags = re.compile("", self.flags).flags
+        return all(p.flags == flags for p, _ in self._handlers)
 
 
 class TgBot(Bot):
@@ -723,6 +1351,8 @@ class InlineQuery:
     See https://core.telegram.org/bots/api#inline-mode for details
     """
 
+    __slots__ = ("bot", "sender", "query_id", "query")
+
     def __init__(self, bot, src):
         self.bot = bot
         self.sender = Sender(src["from"])
@@ -733,7 +1363,7 @@ class InlineQuery:
         return self.bot.api_call(
             "answerInlineQuery",
             inline_query_id=self.query_id,
-            results=self.bot.json_serialize(results),
+            results=results,
             **options
         )
 
@@ -745,6 +1375,15 @@ class TgInlineQuery(InlineQuery):
 
 
 class ChosenInlineResult:
+    __slots__ = (
+        "bot",
+        "sender",
+        "result_id",
+        "location",
+        "inline_message_id",
+        "query",
+    )
+
     def __init__(self, bot, src):
         self.bot = bot
         self.sender = Sender(src["from"])
@@ -755,6 +1394,8 @@ class ChosenInlineResult:
 
 
 class CallbackQuery:
+    __slots__ = ("bot", "query_id", "data", "src")
+
     def __init__(self, bot, src):
         self.bot = bot
         self.query_id = src["id"]
@@ -768,6 +1409,15 @@ class CallbackQuery:
 
 
 class PreCheckoutQuery:
+    __slots__ = (
+        "bot",
+        "sender",
+        "query_id",
+        "currency",
+        "total_amount",
+        "invoice_payload",
+    )
+
     def __init__(self, bot, src):
         self.bot = bot
         self.sender = Sender(src["from"])
@@ -8,6 +8,8 @@ class Chat:
     Wrapper for telegram chats, passed to most callbacks
     """
 
+    __slots__ = ("bot", "message", "sender", "id", "type")
+
     def send_text(self, text, **options):
         """
         Send a text message to the chat.
@@ -34,7 +36,7 @@ class Chat:
             text,
             reply_to_message_id=self.message["message_id"],
             disable_web_page_preview="true",
-            reply_markup=self.bot.json_serialize(markup),
+            reply_markup=markup,
             parse_mode=parse_mode,
         )
 
@@ -55,7 +57,7 @@ class Chat:
             self.id,
             message_id,
             text,
-            reply_markup=self.bot.json_serialize(markup),
+            reply_markup=markup,
             parse_mode=parse_mode,
         )
 
@@ -67,7 +69,7 @@ class Chat:
         :param dict markup: Markup options
         """
         return self.bot.edit_message_reply_markup(
-            self.id, message_id, reply_markup=self.bot.json_serialize(markup)
+            self.id, message_id, reply_markup=markup
         )
 
     def get_chat(self):
@@ -277,7 +279,7 @@ class Chat:
 
     def send_media_group(
         self,
-        media: str,
+        media: list,
         disable_notification: bool = False,
         reply_to_message_id: int = None,
         **options
@@ -285,8 +287,8 @@ class Chat:
         """
         Send a group of photos or videos as an album
 
-        :param media: A JSON-serialized array describing photos and videos
-        to be sent, must include 2–10 items
+        :param media: A list of dicts describing photos and videos to be
+        sent, must include 2–10 items (a JSON-serialized string works too)
         :param disable_notification: Sends the messages silently. Users will
         receive a notification with no sound.
         :param reply_to_message_id: If the messages are a reply, ID of the original message
@@ -294,7 +296,6 @@ class Chat:
         https://core.telegram.org/bots/api#sendmediagroup)
 
         :Example:
-        >>> from json import dumps
         >>> photos_urls = [
         >>>     "https://telegram.org/img/t_logo.png",
         >>>     "https://telegram.org/img/SiteAndroid.jpg?1",
@@ -304,12 +305,12 @@ class Chat:
         >>> tg_album = []
         >>> count = len(photos_urls)
         >>> for i, p in enumerate(photos_urls):
-        >>> {
-        >>>     'type': 'photo',
-        >>>     'media': p,
-        >>>     'caption': f'{i} of {count}'
-        >>> }
-        >>> await chat.send_media_group(dumps(tg_album))
+        >>>     tg_album.append({
+        >>>         'type': 'photo',
+        >>>         'media': p,
+        >>>         'caption': f'{i} of {count}'
+        >>>     })
+        >>> await chat.send_media_group(tg_album)
         """
 
         return self.bot.api_call(
@@ -369,7 +370,7 @@ class Chat:
 
         :return: ``True`` if this chat is a group, ``False`` otherwise
         """
-        return self.type == "group" or self.type == "supergroup"
+        return self.type in ("group", "supergroup")
 
     def __init__(self, bot, chat_id, chat_type="private", src_message=None):
         self.bot = bot
@@ -404,6 +405,8 @@ class TgChat(Chat):
 class Sender(dict):
     """A small wrapper for sender info, mostly used for logging"""
 
+    __slots__ = ()
+
     def __repr__(self):
         uname = " (%s)" % self["username"] if "username" in self else ""
         return self["first_name"] + uname
@@ -12,3 +12,6 @@ class MockBot(Bot):
         future = asyncio.Future()
         future.set_result("1")
         return future
+
+    async def _api_call(self, method, **params):
+        return await self.api_call(method, **params)
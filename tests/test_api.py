@@ -0,0 +1,493 @@
+import aiohttp
+import asyncio
+import json
+import logging
+import pytest
+import threading
+
+from aiotg import Bot, BotApiError
+from aiotg.bot import POLLING_CONNECTION_LIMIT
+from testfixtures import LogCapture
+
+API_TOKEN = "test_token"
+
+
+class FakeResponse:
+    released = False
+
+    def __init__(self, status, body, headers=None):
+        self.status = status
+        self.body = body
+        self.headers = {"content-type": "application/json"}
+        self.headers.update(headers or {})
+        self.content_type = self.headers["content-type"]
+
+    async def json(self, loads=None):
+        return self.body
+
+    async def read(self):
+        if isinstance(self.body, str):
+            return self.body.encode()
+        return json.dumps(self.body).encode()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.released = True
+
+
+class FakeSession:
+    closed = False
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def post(self, url, **kwargs):
+        self.calls.append((url, kwargs))
+        return self.responses.pop(0)
+
+    async def close(self):
+        self.closed = True
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    calls = []
+
+    async def sleep(delay):
+        calls.append(delay)
+
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+    return calls
+
+
+def test_api_call_retries(sleeps):
+    bot = Bot(API_TOKEN)
+    responses = [
+        FakeResponse(502, "Bad Gateway", {"content-type": "text/plain"}),
+        FakeResponse(429, {"ok": False, "parameters": {"retry_after": 5}}),
+        FakeResponse(200, {"ok": True, "result": 42}),
+    ]
+    bot._session = FakeSession(*responses)
+
+    result = run(bot._api_call("getMe"))
+    assert result == {"ok": True, "result": 42}
+    assert len(bot._session.calls) == 3
+    assert all(response.released for response in responses)
+    assert 1 <= sleeps[0] < 2
+    assert 5 <= sleeps[1] < 6
+
+
+def test_api_call_max_retries(sleeps):
+    bot = Bot(API_TOKEN, max_retries=1)
+    bot._session = FakeSession(
+        FakeResponse(502, "Bad Gateway", {"content-type": "text/plain"}),
+        FakeResponse(502, "Bad Gateway", {"content-type": "text/plain"}),
+    )
+
+    with pytest.raises(BotApiError, match="Bad Gateway"):
+        run(bot._api_call("getMe"))
+    assert len(bot._session.calls) == 2
+    assert len(sleeps) == 1
+
+
+def test_api_call_error():
+    bot = Bot(API_TOKEN)
+    bot._session = FakeSession(
+        FakeResponse(400, {"ok": False, "description": "Bad Request"})
+    )
+
+    with pytest.raises(BotApiError, match="Bad Request"):
+        run(bot._api_call("sendMessage", chat_id=1))
+    url, _ = bot._session.calls[0]
+    assert url == "https://api.telegram.org/bottest_token/sendMessage"
+
+
+def test_api_call_body():
+    bot = Bot(API_TOKEN)
+    bot._session = FakeSession(
+        FakeResponse(200, {"ok": True}), FakeResponse(200, {"ok": True})
+    )
+    markup = {"inline_keyboard": [[{"text": "ok", "callback_data": "ok"}]]}
+
+    run(bot._api_call("sendMessage", chat_id=1, text="hi", reply_markup=markup))
+    run(bot._api_call("sendPhoto", chat_id=1, photo=b"png", reply_markup=markup))
+
+    _, kwargs = bot._session.calls[0]
+    assert kwargs == {"json": {"chat_id": 1, "text": "hi", "reply_markup": markup}}
+    _, kwargs = bot._session.calls[1]
+    assert kwargs["data"] == {
+        "chat_id": "1",
+        "photo": b"png",
+        "reply_markup": bot.json_serialize(markup),
+    }
+
+
+def test_coalesce(sleeps):
+    bot = Bot(API_TOKEN)
+    bot._session = FakeSession(
+        FakeResponse(200, {"ok": True, "result": 1}),
+        FakeResponse(200, {"ok": True, "result": 2}),
+    )
+
+    async def send():
+        return await asyncio.gather(
+            bot.send_message(1, "foo", coalesce=True),
+            bot.send_message(1, "bar", coalesce=True),
+            bot.send_message(1, "baz", coalesce=True, parse_mode="HTML"),
+        )
+
+    results = run(send())
+    assert [r["result"] for r in results] == [1, 1, 2]
+    assert [kwargs["json"] for _, kwargs in bot._session.calls] == [
+        {"chat_id": 1, "text": "foo\nbar"},
+        {"chat_id": 1, "text": "baz", "parse_mode": "HTML"},
+    ]
+
+
+def test_coalesce_order():
+    bot = Bot(API_TOKEN)
+    bot._session = FakeSession(
+        *[FakeResponse(200, {"ok": True, "result": i}) for i in range(7)]
+    )
+
+    async def send():
+        return await asyncio.gather(
+            bot.send_message(1, "foo", coalesce=True),
+            # Sent right away, but only after "foo"
+            bot.send_message(1, "bar"),
+            bot.send_message(1, "baz", coalesce=True),
+            bot.send_message(1, "qux", coalesce=True, reply_markup={"keyboard": []}),
+            # Different options close the open batch instead of joining
+            # an older one
+            bot.send_message(1, "A1", coalesce=True),
+            bot.send_message(1, "B1", coalesce=True, parse_mode="HTML"),
+            bot.send_message(1, "A2", coalesce=True),
+        )
+
+    results = run(send())
+    assert [r["result"] for r in results] == [0, 1, 2, 3, 4, 5, 6]
+    assert [kwargs["json"]["text"] for _, kwargs in bot._session.calls] == [
+        "foo",
+        "bar",
+        "baz",
+        "qux",
+        "A1",
+        "B1",
+        "A2",
+    ]
+    assert not bot._sending
+
+
+def test_coalesce_close():
+    bot = Bot(API_TOKEN)
+    session = bot._session = FakeSession(FakeResponse(200, {"ok": True, "result": 1}))
+
+    async def send():
+        future = bot.send_message(1, "foo", coalesce=True)
+        await bot.close()
+        return future.result()
+
+    assert run(send())["result"] == 1
+    assert [kwargs["json"]["text"] for _, kwargs in session.calls] == ["foo"]
+    assert session.closed
+
+
+class PollBot(Bot):
+    def __init__(self, *batches):
+        super().__init__(API_TOKEN)
+        self.batches = list(batches)
+        self.offsets = []
+
+    def api_call(self, method, **params):
+        self.offsets.append(params["offset"])
+        future = asyncio.get_event_loop().create_future()
+        batch = self.batches.pop(0) if self.batches else []
+        if isinstance(batch, Exception):
+            future.set_exception(batch)
+        else:
+            future.set_result({"ok": True, "result": batch})
+        return future
+
+    async def _api_call(self, method, **params):
+        return await self.api_call(method, **params)
+
+
+def message(update_id, text):
+    msg = {"message_id": 0, "chat": {"id": 0, "type": "private"}, "text": text}
+    return {"update_id": update_id, "message": msg}
+
+
+def test_loop_pipelining():
+    bot = PollBot([message(1, "foo"), message(2, "bar")], [message(3, "stop")])
+    seen = []
+
+    @bot.default
+    def default(chat, msg):
+        # Next poll is already issued with the advanced offset
+        seen.append((msg["text"], bot.offsets[-1]))
+        if msg["text"] == "stop":
+            bot.stop()
+
+    run(bot.loop())
+    assert seen == [("foo", 3), ("bar", 3), ("stop", 4)]
+    # The poll issued before "stop" was cancelled, so the last batch
+    # gets confirmed on exit
+    assert bot.offsets == [1, 3, 4, 4]
+
+
+@pytest.mark.parametrize(
+    "eager",
+    [
+        False,
+        pytest.param(
+            True,
+            marks=pytest.mark.skipif(
+                not hasattr(asyncio, "eager_task_factory"),
+                reason="requires eager_task_factory",
+            ),
+        ),
+    ],
+)
+def test_run_eager(eager):
+    bot = PollBot([message(1, "stop")])
+    factories = []
+
+    @bot.default
+    def default(chat, msg):
+        factories.append(asyncio.get_running_loop().get_task_factory())
+        bot.stop()
+
+    def main():
+        # run() uses the current event loop, keep it away from other tests
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            bot.run(eager=eager)
+            factories.append(loop.get_task_factory())
+        finally:
+            loop.close()
+
+    thread = threading.Thread(target=main)
+    thread.start()
+    thread.join()
+    expected = asyncio.eager_task_factory if eager else None
+    # The previous factory is back once run() returns
+    assert factories == [expected, None]
+
+
+def test_loop_errors(sleeps):
+    error = aiohttp.ClientConnectionError("connection reset")
+    bot = PollBot(error, error, [message(1, "stop")])
+
+    @bot.default
+    def default(chat, msg):
+        bot.stop()
+
+    run(bot.loop())
+    assert bot.offsets == [1, 1, 1, 2, 2]
+    assert 1 <= sleeps[0] < 2
+    assert 2 <= sleeps[1] < 3
+
+
+def test_schedule_handlers():
+    bot = Bot(API_TOKEN)
+    called_with = []
+
+    @bot.command(r"/async")
+    async def async_handler(chat, match):
+        called_with.append("async")
+
+    @bot.default
+    def future_handler(chat, message):
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: called_with.append(f.result()))
+        future.set_result("future")
+        return future
+
+    async def main():
+        for text in ("/async", "foo"):
+            msg = {"message_id": 0, "chat": {"id": 0, "type": "private"}, "text": text}
+            bot._process_update({"update_id": 0, "message": msg})
+        await asyncio.sleep(0)
+
+    run(main())
+    assert sorted(called_with) == ["async", "future"]
+
+
+def test_schedule_ignores_plain_results():
+    bot = Bot(API_TOKEN)
+
+    @bot.default
+    def default(chat, message):
+        return False
+
+    async def main():
+        msg = {"message_id": 0, "chat": {"id": 0, "type": "private"}, "text": "foo"}
+        bot._process_update({"update_id": 0, "message": msg})
+        assert not bot._tasks
+
+    run(main())
+
+
+def test_polling_session():
+    bot = Bot(API_TOKEN)
+    bot._session = FakeSession(FakeResponse(200, {"ok": True, "result": True}))
+    bot._poll_session = FakeSession(FakeResponse(200, {"ok": True, "result": []}))
+
+    run(bot._api_call("getUpdates", offset=1))
+    run(bot._api_call("sendMessage", chat_id=1, text="foo"))
+    assert [url for url, _ in bot._poll_session.calls] == [
+        "https://api.telegram.org/bottest_token/getUpdates"
+    ]
+    assert [url for url, _ in bot._session.calls] == [
+        "https://api.telegram.org/bottest_token/sendMessage"
+    ]
+
+
+def test_connection_limit():
+    async def limits():
+        bot = Bot(API_TOKEN, connection_limit=8)
+        try:
+            return bot.session.connector.limit, bot._polling_session.connector.limit
+        finally:
+            await bot.close()
+
+    assert run(limits()) == (8, POLLING_CONNECTION_LIMIT)
+
+
+def test_handler_errors():
+    bot = Bot(API_TOKEN)
+
+    async def fail():
+        raise ValueError("boom")
+
+    async def dispatch():
+        bot._schedule(fail())
+        await asyncio.gather(*bot._tasks, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    with LogCapture(level=logging.ERROR) as log:
+        run(dispatch())
+    (record,) = log.records
+    assert record.getMessage() == "Handler failed"
+    assert isinstance(record.exc_info[1], ValueError)
+    assert not bot._tasks
+
+
+def test_sequential_chats():
+    bot = Bot(API_TOKEN, sequential_chats=True)
+    events = []
+
+    @bot.default
+    async def default(chat, message):
+        events.append(("start", message["text"]))
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        events.append(("end", message["text"]))
+
+    def update(chat_id, text):
+        chat = {"id": chat_id, "type": "private"}
+        return {"update_id": 0, "message": {"chat": chat, "text": text}}
+
+    async def dispatch():
+        bot._process_updates(
+            {"ok": True, "result": [update(1, "a1"), update(2, "b1"), update(1, "a2")]}
+        )
+        while bot._tasks:
+            await asyncio.gather(*bot._tasks)
+
+    run(dispatch())
+    # Chats run concurrently, messages within a chat one by one
+    assert events == [
+        ("start", "a1"),
+        ("start", "b1"),
+        ("end", "a1"),
+        ("start", "a2"),
+        ("end", "b1"),
+        ("end", "a2"),
+    ]
+    assert not bot._chat_queues
+
+
+def test_sequential_chats_eager_start(monkeypatch):
+    bot = Bot(API_TOKEN, sequential_chats=True)
+    handled = []
+
+    @bot.default
+    async def default(chat, message):
+        handled.append(message["text"])
+
+    def schedule_eagerly(coro):
+        # Like eager_task_factory, run the worker right away until it suspends
+        with pytest.raises(StopIteration):
+            coro.send(None)
+
+    monkeypatch.setattr(bot, "_schedule", schedule_eagerly)
+    chat = {"id": 1, "type": "private"}
+    bot._process_update({"update_id": 0, "message": {"chat": chat, "text": "a"}})
+    assert handled == ["a"]
+    assert not bot._chat_queues
+
+
+@pytest.mark.skipif(
+    not hasattr(asyncio, "eager_task_factory"), reason="requires eager_task_factory"
+)
+def test_sequential_chats_eager_task_factory():
+    bot = Bot(API_TOKEN, sequential_chats=True)
+    handled = []
+
+    @bot.default
+    async def default(chat, message):
+        handled.append(message["text"])
+        await asyncio.sleep(0)
+
+    async def dispatch():
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+        chat = {"id": 1, "type": "private"}
+        for text in ("a", "b"):
+            bot._process_update(
+                {"update_id": 0, "message": {"chat": chat, "text": text}}
+            )
+        while bot._tasks:
+            await asyncio.gather(*bot._tasks)
+
+    run(dispatch())
+    assert handled == ["a", "b"]
+    assert not bot._chat_queues
+
+
+def test_max_concurrency():
+    bot = Bot(API_TOKEN, max_concurrency=2)
+    running = 0
+    peak = 0
+
+    @bot.default
+    async def default(chat, message):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        for _ in range(3):
+            await asyncio.sleep(0)
+        running -= 1
+
+    async def main():
+        msg = {"message_id": 0, "chat": {"id": 0, "type": "private"}, "text": "foo"}
+        for i in range(5):
+            bot._process_update({"update_id": i, "message": msg})
+        assert len(bot._tasks) == 5
+        await bot._wait_for_handlers(1)
+
+    run(main())
+    assert peak == 2
+    assert not bot._tasks
@@ -1,5 +1,7 @@
+import logging
 import pytest
 import random
+import re
 
 from aiotg import Bot, Chat, InlineQuery
 from aiotg import MESSAGE_TYPES, MESSAGE_UPDATES
@@ -261,7 +263,7 @@ def test_inline_answer():
     ]
     iq.answer(results)
     assert "answerInlineQuery" in bot.calls
-    assert isinstance(bot.calls["answerInlineQuery"]["results"], str)
+    assert bot.calls["answerInlineQuery"]["results"] == results
 
 
 def test_edit_message():
@@ -285,5 +287,253 @@ def test_edit_reply_markup():
     chat.edit_reply_markup(message_id, {"inline_keyboard": [["ok", "cancel"]]})
     assert "editMessageReplyMarkup" in bot.calls
     call = bot.calls["editMessageReplyMarkup"]
-    assert call["reply_markup"] == '{"inline_keyboard": [["ok", "cancel"]]}'
+    assert call["reply_markup"] == {"inline_keyboard": [["ok", "cancel"]]}
     assert call["message_id"] == message_id
+
+
+@pytest.fixture(params=["re", "hyperscan"])
+def matcher(request):
+    # Whether the bot should prefilter with hyperscan
+    if request.param == "hyperscan":
+        pytest.importorskip("hyperscan")
+    return request.param == "hyperscan"
+
+
+def test_command_order(matcher):
+    bot = Bot(API_TOKEN, use_hyperscan=matcher)
+    called = []
+
+    @bot.command(r"/echo (.+)")
+    def echo(chat, match):
+        called.append(("echo", match.group(1)))
+
+    @bot.command(r"(\w+) (\w+)")
+    def words(chat, match):
+        called.append(("words", match.group(2)))
+
+    @bot.command(r"(?P<first>\w+)")
+    def word(chat, match):
+        called.append(("word", match.group("first")))
+
+    # The first registered pattern wins even if a later one matches earlier
+    bot._process_message(text_msg("hello /echo foo"))
+    bot._process_message(text_msg("hello world"))
+    bot._process_message(text_msg("hello"))
+    assert called == [("echo", "foo"), ("words", "world"), ("word", "hello")]
+    assert bool(bot._commands._database) == matcher
+
+
+def test_command_backreference(matcher):
+    bot = Bot(API_TOKEN, use_hyperscan=matcher)
+    called_with = None
+
+    @bot.command(r"/never")
+    def never(chat, match):
+        assert False
+
+    @bot.command(r"(\w)\1")
+    def double(chat, match):
+        nonlocal called_with
+        called_with = match.group(0)
+
+    bot._process_message(text_msg("abba"))
+    assert called_with == "bb"
+
+
+@pytest.mark.parametrize("pattern, text", [(r"a{,3}b", "aab"), (r"a\sb", "a\x1cb")])
+def test_command_prefilter_syntax(matcher, pattern, text):
+    bot = Bot(API_TOKEN, use_hyperscan=matcher)
+    called_with = None
+
+    @bot.command(r"/never")
+    def never(chat, match):
+        assert False
+
+    @bot.command(pattern)
+    def command(chat, match):
+        nonlocal called_with
+        called_with = match.group(0)
+
+    bot._process_message(text_msg(text))
+    assert called_with == text
+    assert not bot._commands._database
+
+
+def test_compiled_command(matcher):
+    bot = Bot(API_TOKEN, use_hyperscan=matcher)
+    called = []
+
+    @bot.command(re.compile(r"/Exact"))
+    def exact(chat, match):
+        called.append("exact")
+
+    @bot.command(r"/exact")
+    def anycase(chat, match):
+        called.append("anycase")
+
+    bot._process_message(text_msg("/Exact"))
+    bot._process_message(text_msg("/EXACT"))
+    assert called == ["exact", "anycase"]
+
+
+def test_literal_commands():
+    bot = Bot(API_TOKEN)
+    called = []
+
+    @bot.command(r"/start")
+    def start(chat, match):
+        called.append(("start", match.group(0)))
+
+    @bot.command(r"^/help")
+    def help(chat, match):
+        called.append(("help", match.group(0)))
+
+    @bot.command(r"/star")
+    def star(chat, match):
+        called.append(("star", match.group(0)))
+
+    @bot.command(r"^/echo (.+)")
+    def echo(chat, match):
+        called.append(("echo", match.group(1)))
+
+    @bot.command(r"(\w+)")
+    def word(chat, match):
+        called.append(("word", match.group(1)))
+
+    bot._process_message(text_msg("/start@mybot"))
+    bot._process_message(text_msg("/HELP me"))
+    # Matched by an earlier registered pattern
+    bot._process_message(text_msg("/star /start"))
+    bot._process_message(text_msg("/stars"))
+    bot._process_message(text_msg("/echo foo bar"))
+    # The command pattern doesn't match, a later one does
+    bot._process_message(text_msg("/echo"))
+    assert called == [
+        ("start", "/start"),
+        ("help", "/HELP"),
+        ("start", "/start"),
+        ("star", "/star"),
+        ("echo", "foo bar"),
+        ("word", "echo"),
+    ]
+
+
+def test_custom_message_type():
+    bot = Bot(API_TOKEN)
+    called = []
+
+    @bot.command(r"hello")
+    def hello(chat, match):
+        called.append("hello")
+
+    bot._process_message(text_msg("hello"))
+
+    @bot.handle("reply_to_message")
+    def reply(chat, original):
+        called.append(original["text"])
+
+    # Custom types can come with text and take precedence over commands
+    bot._process_message(
+        custom_msg({"text": "hello", "reply_to_message": {"text": "hi"}})
+    )
+    assert called == ["hello", "hi"]
+
+
+def test_allowed_updates():
+    bot = Bot(API_TOKEN)
+    messages = ["message", "edited_message", "channel_post", "edited_channel_post"]
+    assert bot._allowed_updates() == messages
+
+    @bot.callback
+    def callback(chat, cq):
+        pass
+
+    @bot.inline(r"foo")
+    def inline(iq, match):
+        pass
+
+    assert bot._allowed_updates() == messages + ["inline_query", "callback_query"]
+
+
+def test_slash_anchored_command(matcher):
+    bot = Bot(API_TOKEN, use_hyperscan=matcher)
+    called = []
+
+    @bot.command(r"^/echo (.+)")
+    def echo(chat, match):
+        called.append(("echo", match.group(1)))
+
+    @bot.command(r"^/?help")
+    def help(chat, match):
+        called.append(("help", match.group(0)))
+
+    @bot.command(re.compile(r"^/ ?start", re.X | re.I))
+    def start(chat, match):
+        called.append(("start", match.group(0)))
+
+    @bot.command(r"echo (.+)")
+    def plain(chat, match):
+        called.append(("plain", match.group(1)))
+
+    bot._process_message(text_msg("/echo foo"))
+    bot._process_message(text_msg("echo bar"))
+    bot._process_message(text_msg("help"))
+    bot._process_message(text_msg("start"))
+    assert called == [
+        ("echo", "foo"),
+        ("plain", "bar"),
+        ("help", "help"),
+        ("start", "start"),
+    ]
+    assert len(bot._commands._unslashed) == 3
+
+
+def test_track():
+    class TrackingBot(Bot):
+        tracked = []
+
+        def track(self, message, name="Message"):
+            self.tracked.append(name)
+
+    bot = TrackingBot(API_TOKEN)
+
+    @bot.command(r"/echo (.+)")
+    def echo(chat, match):
+        pass
+
+    bot._process_message(text_msg("/echo foo"))
+    bot._process_message(text_msg("foo"))
+    assert bot.tracked == ["echo", "default"]
+
+
+def test_track_assigned():
+    bot = Bot(API_TOKEN)
+    tracked = []
+    bot.track = lambda message, name="Message": tracked.append(name)
+
+    bot._process_message(text_msg("foo"))
+    bot._process_message({"chat": {"id": 0, "type": "private"}, "photo": []})
+    assert tracked == ["default", "photo"]
+
+
+def test_update_dispatch():
+    bot = Bot(API_TOKEN)
+    called_with = None
+
+    @bot.callback
+    def callback(chat, cq):
+        nonlocal called_with
+        called_with = cq.data
+
+    bot._process_update({"update_id": 0, "callback_query": callback_query("foo")})
+    assert called_with == "foo"
+
+    with LogCapture(level=logging.ERROR) as log:
+        bot._process_update({"update_id": 1, "poll": {}})
+        log.check(
+            (
+                "aiotg",
+                "ERROR",
+                "don't know how to handle update: {'update_id': 1, 'poll': {}}",
+            )
+        )
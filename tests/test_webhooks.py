@@ -61,7 +61,66 @@ def test_set_webhook():
     assert "secret_token" in bot.calls["setWebhook"]
 
 
+def test_set_webhook_allowed_updates():
+    bot = MockBot()
+
+    @bot.callback
+    def callback(chat, cq):
+        pass
+
+    bot.set_webhook(webhook_url)
+    allowed_updates = bot.calls["setWebhook"]["allowed_updates"]
+    assert "callback_query" in allowed_updates
+    assert "inline_query" not in allowed_updates
+
+    bot.set_webhook(webhook_url, allowed_updates=["message"])
+    assert bot.calls["setWebhook"]["allowed_updates"] == ["message"]
+
+
 def test_delete_webhook():
     bot = MockBot()
     bot.delete_webhook()
     assert "deleteWebhook" in bot.calls
+
+
+class FakeRequest:
+    def __init__(self, update, token=None):
+        self.update = update
+        self.headers = {}
+        if token is not None:
+            self.headers["X-Telegram-Bot-Api-Secret-Token"] = token
+
+    async def json(self, loads=None):
+        return self.update
+
+
+def test_webhook_secret_token():
+    bot = MockBot()
+    called = []
+
+    @bot.default
+    def default(chat, message):
+        called.append(message["text"])
+
+    bot.set_webhook(webhook_url)
+    token = bot.calls["setWebhook"]["secret_token"]
+    message = {"message_id": 0, "chat": {"id": 0, "type": "private"}, "text": "hi"}
+    update = {"update_id": 0, "message": message}
+
+    loop = asyncio.new_event_loop()
+    try:
+        for request in [
+            FakeRequest(update),
+            FakeRequest(update, "wrong"),
+            FakeRequest(update, "\udcff"),
+            FakeRequest(update, "\ud800"),
+        ]:
+            response = loop.run_until_complete(bot.webhook_handle(request))
+            assert response.status == 403
+        response = loop.run_until_complete(
+            bot.webhook_handle(FakeRequest(update, token))
+        )
+        assert response.status == 200
+    finally:
+        loop.close()
+    assert called == ["hi"]